@@ -0,0 +1,55 @@
+#!/usr/bin/env python2.7
+
+#Compares get_possible_votes against the HTMLParser based version it replaced,
+#checking they agree and timing both. The corpus is the body_html of comments
+#from the comment databases the bot keeps next to its state files, or from
+#files with one JSON encoded body_html per line.
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import vote_count
+
+parser = argparse.ArgumentParser(description="Benchmark vote extraction from comment html")
+parser.add_argument("corpus", nargs='+', help="*_comments.db files or files of JSON body_html lines")
+parser.add_argument("--repeat", type=int, default=5, help="number of times to parse the corpus")
+
+def load_corpus(filename):
+    if filename.endswith('.db'):
+        db = sqlite3.connect(filename)
+        return [x for x, in db.execute("SELECT body_html FROM comments WHERE body_html IS NOT NULL")]
+    with open(filename) as corpus_fd:
+        return [json.loads(line) for line in corpus_fd if line.strip()]
+
+def time_parser(get_possible_votes, corpus, repeat):
+    best = float('Inf')
+    for i in range(repeat):
+        start_time = time.time()
+        for body_html in corpus:
+            get_possible_votes(body_html)
+        best = min(best, time.time() - start_time)
+    return best
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    corpus = []
+    for filename in args.corpus:
+        corpus.extend(load_corpus(filename))
+    if not corpus:
+        sys.exit("No comments in corpus")
+
+    mismatches = 0
+    for body_html in corpus:
+        old = vote_count.get_possible_votes_htmlparser(body_html)
+        new = vote_count.get_possible_votes(body_html)
+        if old != new:
+            mismatches += 1
+            print("Mismatch for {!r}: {!r} != {!r}".format(body_html, old, new))
+
+    old_time = time_parser(vote_count.get_possible_votes_htmlparser, corpus, args.repeat)
+    new_time = time_parser(vote_count.get_possible_votes, corpus, args.repeat)
+    print("{} comments, {} mismatches".format(len(corpus), mismatches))
+    print("HTMLParser:   {:.3f}s".format(old_time))
+    print("single pass:  {:.3f}s ({:.1f}x)".format(new_time, old_time / new_time))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python2.7
+
+#Checks compare_dicts against the tuple set version it replaced, on random
+#old and new votes. Both the differences and the vote history events made
+#from them (for both kinds of game) have to agree.
+
+import sys
+import json
+import time
+import random
+import argparse
+import vote_count
+
+parser = argparse.ArgumentParser(description="Check compare_dicts against the version it replaced")
+parser.add_argument("--cases", type=int, default=20000, help="number of random pairs of votes to compare")
+parser.add_argument("--seed", type=int, default=0, help="random seed")
+
+def compare_dicts_tuples(old, new):
+    old_items = set([(k,) + tuple(v.items()) for k,v in old.iteritems()])
+    new_items = set([(k,) + tuple(v.items()) for k,v in new.iteritems()])
+
+    additions = new_items.difference(old_items)
+    removals = old_items.difference(new_items)
+
+    additions = {i[0]: dict(i[1:]) for i in additions}
+    removals = {i[0]: dict(i[1:]) for i in removals}
+
+    return additions, removals
+
+class EventLog(object):
+    """Stands in for a StateTransaction, keeping the events appended to it"""
+    def __init__(self):
+        self.events = []
+
+    def append(self, path, event):
+        self.events.append(event)
+
+def history_events(bot, old, new, compare_dicts):
+    """The events record_vote_changes adds, with the differences from compare_dicts"""
+    log = EventLog()
+    original = vote_count.compare_dicts
+    vote_count.compare_dicts = compare_dicts
+    try:
+        bot.record_vote_changes(log, ('votes', 'post'), old, new)
+    finally:
+        vote_count.compare_dicts = original
+    #the old version added events in whatever order the set gave them
+    return sorted(json.dumps(event, sort_keys = True, default = vote_count.record_to_json)
+                  for event in log.events)
+
+def random_votes(rnd, names, old = None):
+    votes = {}
+    for voter in rnd.sample(names, rnd.randint(0, len(names))):
+        if old and voter in old and rnd.random() < 0.4:
+            #unchanged, as get_votes gives it
+            votes[voter] = old[voter]
+        elif old and voter in old and rnd.random() < 0.3:
+            #the same vote, as a new record
+            votes[voter] = vote_count.VoteRecord.from_json(old[voter].to_json())
+        else:
+            votes[voter] = vote_count.VoteRecord.from_json({
+                "for": rnd.choice([None, rnd.choice(names)]),
+                "lynch": rnd.choice(names + [True, False]),
+                "timestamp": rnd.randint(0, 5)})
+    return votes
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    names = ['player{}'.format(i) for i in range(10)]
+    bots = [vote_count.VoteBot.__new__(vote_count.VoteBot),
+            vote_count.TraditionalBot.__new__(vote_count.TraditionalBot)]
+    #removals of voters who are gone are stamped with the time
+    time.time = lambda: 1000
+
+    mismatches = 0
+    for i in range(args.cases):
+        old = random_votes(rnd, names)
+        new = random_votes(rnd, names, old)
+        same = vote_count.compare_dicts(old, new) == compare_dicts_tuples(old, new)
+        for bot in bots:
+            same = same and (history_events(bot, old, new, vote_count.compare_dicts) ==
+                             history_events(bot, old, new, compare_dicts_tuples))
+        if not same:
+            mismatches += 1
+            print("Mismatch for {!r} -> {!r}".format(old, new))
+
+    print("{} cases, {} mismatches".format(args.cases, mismatches))
+    sys.exit(1 if mismatches else 0)
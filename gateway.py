@@ -0,0 +1,137 @@
+#!/usr/bin/env python2.7
+
+#All requests to reddit go through the praw handler, so this is where we can
+#keep under reddit's rate limits and count what is using up our requests.
+#praw sessions aren't safe to share between threads, so games running in
+#their own threads each have a session, with a handler sharing one
+#TokenBucket and RequestStats. The TokenBucket takes the place of praw's rate
+#limit, which only lets one request be made at a time
+
+import time
+import urlparse
+import threading
+import collections
+import praw.handlers
+
+#Statuses worth trying again after a pause, rather than failing the update
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+#Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('Inf')]
+
+_local = threading.local()
+
+def set_game(name):
+    """Set the game requests from this thread are counted against"""
+    _local.game = name
+
+def get_game():
+    return getattr(_local, 'game', '-')
+
+def endpoint_name(url):
+    """Collapse a request url to the endpoint it uses, dropping ids and names"""
+    segments = [x for x in urlparse.urlparse(url).path.split('/') if x]
+    if not segments:
+        return '/'
+    if segments[0] == 'api':
+        segments = segments[:3] if segments[1:2] == ['v1'] else segments[:2]
+    elif segments[0] == 'message':
+        segments = segments[:2]
+    else:
+        segments = segments[:1]
+    return '/' + '/'.join(segments)
+
+class TokenBucket(object):
+    """Lets requests from all threads through at an average of rate per
+    second, allowing bursts of up to burst requests"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class RequestStats(object):
+    """Request counts, failures and latency histograms per game and endpoint"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        self.latency = collections.defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+
+    def record(self, key, latency, status, retried):
+        with self.lock:
+            self.counts[key] += 1
+            if status >= 400:
+                self.errors[key] += 1
+            if retried:
+                self.retries[key] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self.latency[key][i] += 1
+                    break
+
+    def report(self):
+        """Returns a summary of the requests since the last report and resets the counters"""
+        with self.lock:
+            lines = []
+            for key in sorted(self.counts):
+                game, endpoint = key
+                histogram = ' '.join('<{}s:{}'.format(bound, n) for bound, n
+                                     in zip(LATENCY_BUCKETS, self.latency[key]) if n)
+                lines.append("{} {}: {} requests, {} errors, {} retried [{}]".format(
+                             game, endpoint, self.counts[key], self.errors[key],
+                             self.retries[key], histogram))
+            self.reset()
+        return '\n'.join(lines)
+
+class GatewayHandler(praw.handlers.DefaultHandler):
+    """praw handler which puts every request that isn't answered from praw's
+    cache through a shared TokenBucket, retries requests that fail because
+    reddit is busy and records stats"""
+    def __init__(self, bucket, stats = None, max_retries = 3, retry_delay = 2):
+        praw.handlers.DefaultHandler.__init__(self)
+        self.bucket = bucket
+        self.stats = stats if stats else RequestStats()
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def send(self, request, proxies, timeout, verify, **_):
+        """Make a request which praw's cache couldn't answer. This goes
+        straight to the session rather than through praw's own rate limit,
+        which holds a lock for the whole of each request, so requests from
+        several threads would still be made one at a time"""
+        key = (get_game(), endpoint_name(request.url))
+        settings = self.http.merge_environment_settings(request.url, proxies, False, verify, None)
+        attempt = 0
+        while True:
+            self.bucket.take()
+            start_time = time.time()
+            response = self.http.send(request, timeout = timeout, allow_redirects = False, **settings)
+            self.stats.record(key, time.time() - start_time,
+                              response.status_code, attempt > 0)
+            if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                return response
+            try:
+                delay = float(response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                delay = self.retry_delay * 2 ** attempt
+            attempt += 1
+            time.sleep(delay)
+
+    #only requests which go to reddit take a token and are counted
+    request = praw.handlers.DefaultHandler.with_cache(send)
@@ -1,5 +1,7 @@
 #extracted from bottle.py
+import os
 import functools
+import threading
 import re
 
 class cached_property(object):
@@ -264,3 +266,37 @@ class SimpleTemplate(BaseTemplate):
         self.execute(stdout, kwargs)
         return ''.join(stdout)
 
+    def stream(self, fp, *args, **kwargs):
+        """ Render the template, writing the output to fp as it is produced
+            instead of building it up in memory. %rebase is not supported. """
+        for dictarg in args: kwargs.update(dictarg)
+        self.execute(StreamOutput(fp, self.encoding), kwargs)
+
+class StreamOutput(object):
+    """ Stands in for the output list of SimpleTemplate.execute, encoding
+        and writing each chunk to a file as soon as it is printed. """
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self.encoding = encoding
+
+    def extend(self, parts):
+        self.fp.write(''.join(parts).encode(self.encoding))
+
+
+
+TEMPLATES = {}
+_templates_lock = threading.Lock()
+
+def load_template(filename):
+    """ Return the SimpleTemplate for a template file. Templates are compiled
+        once and kept until the file's modification time changes. """
+    mtime = os.path.getmtime(filename)
+    with _templates_lock:
+        if filename in TEMPLATES and TEMPLATES[filename][0] == mtime:
+            return TEMPLATES[filename][1]
+    with open(filename) as fp:
+        tpl = SimpleTemplate(fp.read())
+    tpl.co # compile before sharing between threads
+    with _templates_lock:
+        TEMPLATES[filename] = (mtime, tpl)
+    return tpl
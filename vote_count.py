@@ -4,21 +4,30 @@ import os
 import re
 import praw
 import json
-import copy
+import bisect
+import contextlib
 import time
 import pytz
+import hashlib
+import tempfile
+import sqlite3
 import creds
 import config
 import os.path
 import logging
 import argparse
 import requests
+import gateway
+import Queue
 import datetime
+import threading
 import traceback
 import prettylog
 import collections
+import praw.errors
 import praw.objects
 import simpletemplate
+import multiprocessing.pool
 
 from HTMLParser import HTMLParser
 
@@ -37,8 +46,16 @@ parser.add_argument("--log_level", help="Log level to use", choices =
                      debug_levels.keys(), default = 'info')
 parser.add_argument("--oneshot", action='store_true', help="run state transition once")
 parser.add_argument("--update_delay", type=int, default=5, help="time in minutes between state updates")
+parser.add_argument("--min_update_delay", type=float, default=1, help="shortest time in minutes between state updates while votes are coming in")
+parser.add_argument("--max_update_delay", type=float, default=20, help="longest time in minutes between state updates for a quiet game")
 parser.add_argument("--dry-run", action='store_true', help="Don't actually post anything")
 parser.add_argument("--oauth-login", action='store_true', help="perform Oauth login")
+parser.add_argument("--parallel_games", type=int, default=4, help="number of games to update at the same time")
+parser.add_argument("--requests_per_minute", type=float, default=60, help="average number of requests per minute to reddit, shared by all games")
+parser.add_argument("--request_burst", type=int, default=5, help="number of requests to reddit which may be made at once before being rate limited")
+parser.add_argument("--comment_workers", type=int, default=1, help="number of requests for more comments in a thread to make at the same time, each on its own session")
+parser.add_argument("--stream_interval", type=float, default=0, help="time in seconds between checks for new votes between updates, to catch hammers straight away (0 to not check)")
+parser.add_argument("--inbox_cursor_file", default="inbox_cursor.json", help="file to keep track of the newest message read in")
 
 Vote = collections.namedtuple("Vote", ["by", "target", "time"])
 Nomination = collections.namedtuple('Nomination', ['player', 'yays', 'nays', 'up_for_trial', 'vote_post_id', 'timestamp'])
@@ -54,66 +71,370 @@ def chunk(l,n):
 
 known_dead_comments = set()
 
+class LRUCache(object):
+    """Dict-like cache which forgets the least recently used entries once it
+    holds more than size of them"""
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default = None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+class CommentCache(object):
+    """The comments we have already fetched through morechildren, by thread.
+    These are looked up again every cycle with /api/info, which picks up
+    edits and deletions, rather than being expanded from their MoreComments
+    stubs again. /api/info doesn't give the replies of the comments it
+    returns, so what each comment is a reply to is kept too, and a comment's
+    replies are looked up along with it. If given a filename the comments and
+    the comments reddit wouldn't give us are kept in an sqlite database so
+    they survive a restart. Only the threads being counted are read from it, and threads
+    which are no longer counted are pruned from it"""
+    #the bodies aren't read back by the bot, but bench_vote_parsing.py
+    #takes its corpus from them
+    comment_fields = ['id', 'body_html', 'parent_id', 'link_id']
+
+    def __init__(self, filename = None):
+        self.parents = {}
+        self.children = collections.defaultdict(set)
+        self.more = {}
+        self.threads = collections.defaultdict(set)
+        self.threads_used = set()
+        self.dead = set()
+        self.db = None
+        if filename:
+            self.load(filename)
+
+    def load(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS comments (id TEXT PRIMARY KEY, "
+                        "body_html TEXT, parent_id TEXT, link_id TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS comments_link_id ON comments (link_id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dead_comments (id TEXT PRIMARY KEY, link_id TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS more_comments (parent_id TEXT PRIMARY KEY, "
+                        "link_id TEXT, children TEXT)")
+
+    def load_thread(self, link_id):
+        """Read in what we know about the comments of the thread link_id, and
+        keep it from being pruned"""
+        self.threads_used.add(link_id)
+        if not self.db or link_id in self.threads:
+            return
+        comment_ids = self.threads[link_id]
+        for comment_id, parent_id in self.db.execute(
+                "SELECT id, parent_id FROM comments WHERE link_id = ?", (link_id,)):
+            self.set_parent(comment_id, parent_id)
+            comment_ids.add(comment_id)
+        self.dead.update(x for x, in self.db.execute(
+                         "SELECT id FROM dead_comments WHERE link_id = ?", (link_id,)))
+        for parent_id, children in self.db.execute(
+                "SELECT parent_id, children FROM more_comments WHERE link_id = ?", (link_id,)):
+            self.more[parent_id] = (link_id, json.loads(children))
+        l.debug("Loaded {} comments of {}".format(len(comment_ids), link_id))
+
+    def prune(self):
+        """Forget the threads which haven't been used since the last prune"""
+        for link_id in set(self.threads).difference(self.threads_used):
+            for comment_id in self.threads.pop(link_id):
+                self.set_parent(comment_id, None)
+        for parent_id, (link_id, children) in self.more.items():
+            if link_id not in self.threads_used:
+                del self.more[parent_id]
+        if self.db:
+            used = list(self.threads_used)
+            placeholders = ', '.join('?' * len(used))
+            self.db.execute("DELETE FROM comments WHERE link_id NOT IN ({})".format(placeholders), used)
+            self.db.execute("DELETE FROM dead_comments WHERE link_id NOT IN ({})".format(placeholders), used)
+            self.db.execute("DELETE FROM more_comments WHERE link_id NOT IN ({})".format(placeholders), used)
+        self.threads_used = set()
+
+    def __contains__(self, comment_id):
+        return comment_id in self.parents
+
+    def add(self, comment):
+        self.set_parent(comment.id, comment.parent_id)
+        self.threads[comment.link_id].add(comment.id)
+        if self.db:
+            #named columns, so databases made with the old, wider table still work
+            self.db.execute("INSERT OR REPLACE INTO comments ({}) VALUES ({})".format(
+                            ', '.join(self.comment_fields), ', '.join('?' * len(self.comment_fields))),
+                            (comment.id, comment.body_html, comment.parent_id, comment.link_id))
+
+    def set_parent(self, comment_id, parent_id):
+        old_parent_id = self.parents.pop(comment_id, None)
+        if old_parent_id:
+            self.children[old_parent_id].discard(comment_id)
+            if not self.children[old_parent_id]:
+                del self.children[old_parent_id]
+        if parent_id is not None:
+            self.parents[comment_id] = parent_id
+            self.children[parent_id].add(comment_id)
+
+    def descendants(self, comment_ids):
+        """The cached replies of comment_ids, their replies and so on, parents
+        before their replies"""
+        found = []
+        replies = comment_ids
+        while replies:
+            replies = [x for comment_id in replies
+                       for x in sorted(self.children.get('t1_{}'.format(comment_id), ()))]
+            found.extend(replies)
+        return found
+
+    def add_more(self, more, link_id):
+        """Remember the ids behind a MoreComments stub found below a comment,
+        since /api/info won't give us the stub when the comment is fetched again"""
+        self.more[more.parent_id] = (link_id, more.children)
+        if self.db:
+            self.db.execute("INSERT OR REPLACE INTO more_comments VALUES (?, ?, ?)",
+                            (more.parent_id, link_id, json.dumps(more.children)))
+
+    def more_children(self, comment_id):
+        return self.more.get('t1_{}'.format(comment_id), (None, []))[1]
+
+    def add_dead(self, comment_ids, link_id):
+        self.dead.update(comment_ids)
+        if self.db:
+            self.db.executemany("INSERT OR IGNORE INTO dead_comments VALUES (?, ?)",
+                                [(x, link_id) for x in comment_ids])
+
+    def commit(self):
+        if self.db:
+            self.db.commit()
+
+#The most children reddit will accept in one morechildren request, and the
+#most ids it will look up in one /api/info request
+MORECHILDREN_LIMIT = 100
+INFO_LIMIT = 100
+
+#Pool to make requests for more comments of one submission at the same time,
+#or None to make them one after another. praw sessions can't be used from
+#several threads at once, so each worker makes its requests on its own session
+comment_workers = None
+worker_local = threading.local()
+
+def set_comment_workers(sessions):
+    """Start a worker for each of sessions, if there is more than one"""
+    global comment_workers
+    if len(sessions) < 2:
+        comment_workers = None
+        return
+    session_queue = Queue.Queue()
+    for session in sessions:
+        session_queue.put(session)
+    comment_workers = multiprocessing.pool.ThreadPool(len(sessions), initializer = take_worker_session,
+                                                      initargs = (session_queue,))
+
+def take_worker_session(session_queue):
+    worker_local.session = session_queue.get()
+
+def request_more_children(session, submission, children_chunk):
+    data = {'children': ','.join(children_chunk),
+            'link_id': submission.fullname,
+            'r': str(submission.subreddit)}
+
+    if submission._comment_sort:
+        data['where'] = submission._comment_sort
+
+    url = session.config['morechildren']
+    return session.request_json(url, data = data)['data']['things']
+
+def request_info(session, submission, ids_chunk):
+    return session.get_info(thing_id = ['t1_{}'.format(x) for x in ids_chunk])
+
+def with_descendants(cache, comment_ids, exclude, dead_comments):
+    """comment_ids followed by their cached replies, other than the dead
+    ones and those in exclude"""
+    replies = [x for x in cache.descendants(comment_ids)
+               if x not in dead_comments and x not in exclude]
+    return list(collections.OrderedDict.fromkeys(comment_ids + replies))
+
 #replace_more_comments is broken because MoreComments.comments() is broken.
 #This is broken I think because the reddit API is broken and doesn't return an
 #additional morecomments object when it should. This also affects the website
-def get_more_comments(self, update = True):
-    if self._comments is not None:
-        return self._comments
-
-    children = {x for x in self.children if 't1_{}'.format(x)
-                    not in self.submission._comments_by_id}
-
-    self._comments = []
-    if not children:
-        return self._comments
-
+def get_more_comments(submission, children, cache = None):
+    """Fetch the comments with the given ids from submission, packing as many
+    ids into each morechildren request as reddit allows. Comments already in
+    the cache are fetched with /api/info instead, along with all their cached
+    replies, since /api/info doesn't give replies. So every cycle costs a
+    request per INFO_LIMIT comments we have fetched from stubs in the thread,
+    not just for those which changed. Ids which reddit won't give us are
+    remembered as dead and not asked for again"""
+    if cache is not None:
+        cache.load_thread(submission.fullname)
+    dead_comments = cache.dead if cache is not None else known_dead_comments
+    children = [x for x in collections.OrderedDict.fromkeys(children)
+                if x not in dead_comments and
+                't1_{}'.format(x) not in submission._comments_by_id]
+    cached = [x for x in children if x in cache] if cache is not None else []
+    children = [x for x in children if cache is None or x not in cache]
+    if cache is not None:
+        cached = with_descendants(cache, cached, set(children), dead_comments)
+    seen = set(cached).union(children)
+
+    game = gateway.get_game()
+    def request_chunk(request):
+        #requests from the pool are counted against the game asking for them
+        gateway.set_game(game)
+        get_things, ids_chunk = request
+        session = getattr(worker_local, 'session', submission.reddit_session)
+        return get_things(session, submission, ids_chunk)
+
+    things = []
     n_attempts = 0
-    old_len = len(children)
-    while children:
-        data = {'children': ','.join(children),
-                'link_id': self.submission.fullname,
-                'r': str(self.submission.subreddit)}
-
-
-        if self.submission._comment_sort:
-            data['where'] = self.submission._comment_sort
-
-        url = self.reddit_session.config['morechildren']
-        response = self.reddit_session.request_json(url, data = data)
-        self._comments.extend(response['data']['things'])
-        children.difference_update(set([x.id for x in self._comments]))
+    while children or cached:
+        fetched = set()
+        requests = ([(request_info, x) for x in chunk(cached, INFO_LIMIT)] +
+                    [(request_more_children, x) for x in chunk(children, MORECHILDREN_LIMIT)])
+        if comment_workers and len(requests) > 1:
+            #map keeps the responses in the order of the requests
+            responses = comment_workers.map(request_chunk, requests)
+        else:
+            responses = (request_chunk(request) for request in requests)
+        for response in responses:
+            for thing in response:
+                things.append(thing)
+                if isinstance(thing, praw.objects.Comment):
+                    fetched.add(thing.id)
+                    if cache is not None:
+                        cache.add(thing)
+                elif cache is not None:
+                    cache.add_more(thing, submission.fullname)
+
+        remaining = [x for x in children if x not in fetched]
+        stuck = len(remaining) == len(children)
+        #cached comments /api/info didn't give us are tried with morechildren
+        lost = [x for x in cached if x not in fetched]
+        #and the stubs morechildren found below the ones it did give us are
+        #expanded the same way as before
+        expanded = []
+        for comment_id in cached:
+            if comment_id in fetched:
+                expanded.extend(x for x in cache.more_children(comment_id)
+                                if x not in seen and x not in dead_comments)
+        expanded = list(collections.OrderedDict.fromkeys(expanded))
+        seen.update(expanded)
+        children = remaining + lost + [x for x in expanded if x not in cache]
+        cached = [x for x in expanded if x in cache]
+        if cached:
+            cached = with_descendants(cache, cached, seen, dead_comments)
+            seen.update(cached)
         n_attempts += 1
-        if n_attempts > 10 or old_len == len(children):
-            if not children.issubset(known_dead_comments):
+        if n_attempts > 10 or (stuck and not lost and not expanded):
+            if children:
                 l.error("Could not fetch comments {} after {} attempts".format(children, n_attempts))
-                known_dead_comments.update(children)
+                if cache is not None:
+                    cache.add_dead(children, submission.fullname)
+                else:
+                    known_dead_comments.update(children)
             break
-        old_len = len(children)
 
-    if update:
-        for comment in self._comments:
-            comment._update_submission(self.submission)
+    for thing in things:
+        #anything they fetch later is fetched on the game's own session
+        thing.reddit_session = submission.reddit_session
+        thing._update_submission(submission)
 
-    return self._comments
+    return things
 
 #replace_more_comments is broken (plus makes more requests than we need)
-def all_comments(replies):
+def all_comments(replies, cache = None):
+    """Yield every comment in replies, expanding all the MoreComments stubs
+    together so that their children share morechildren requests"""
     more_comments = []
     for reply in replies:
         if isinstance(reply, praw.objects.MoreComments):
             more_comments.append(reply)
         else:
             yield reply
+
+    #expanded stubs keep what they expanded to, so walking the same replies
+    #again doesn't go back to reddit
+    for more in more_comments:
+        if more._comments is not None:
+            for comment in more._comments:
+                yield comment
+    more_comments = [more for more in more_comments if more._comments is None]
+
+    #each comment is kept on the stub it was found under: the stub listing
+    #its id, or the stub its parent (or the stub listing it) was found under.
+    #Replies can come back before what they reply to, so this is worked out
+    #once everything has been fetched, which is also when stubs keep their
+    #comments
+    root_more_comments = more_comments
+    owners = {}
+    for more in more_comments:
+        for child in more.children:
+            owners.setdefault(child, id(more))
+    parents = {}
+    fetched = []
+
     while more_comments:
-        more = more_comments.pop()
-        maybe_more = get_more_comments(more)
-        for additional_comment in get_more_comments(more):
+        submission = more_comments[0].submission
+        children = [child for more in more_comments for child in more.children]
+        more_comments = []
+        for additional_comment in get_more_comments(submission, children, cache):
+            parent = (getattr(additional_comment, 'parent_id', None) or '').partition('_')[2]
             if isinstance(additional_comment, praw.objects.MoreComments):
                 more_comments.append(additional_comment)
+                for child in additional_comment.children:
+                    parents.setdefault(child, parent)
             else:
+                parents.setdefault(additional_comment.id, parent)
+                fetched.append(additional_comment)
                 yield additional_comment
 
+    def owner(comment_id):
+        visited = set()
+        while comment_id not in owners and comment_id in parents and comment_id not in visited:
+            visited.add(comment_id)
+            comment_id = parents[comment_id]
+        return owners.get(comment_id)
+
+    expanded = {id(more): [] for more in root_more_comments}
+    for comment in fetched:
+        comment_owner = owner(comment.id)
+        if comment_owner:
+            expanded[comment_owner].append(comment)
+    for more in root_more_comments:
+        more._comments = expanded[id(more)]
+
+class CommentIndex(object):
+    """Every comment below a post, fetched in a single walk of the tree and
+    indexed by the id of the comment it is a reply to"""
+    def __init__(self, post, cache = None):
+        self.children = collections.defaultdict(list)
+        self.comment_ids = set()
+        replies = post.replies
+        while replies:
+            next_replies = []
+            for comment in all_comments(replies, cache):
+                if comment.id in self.comment_ids:
+                    continue
+                self.comment_ids.add(comment.id)
+                self.children[comment.parent_id].append(comment)
+                next_replies.extend(comment.replies)
+            replies = next_replies
+
+    def has_comment(self, comment_id):
+        return comment_id in self.comment_ids
+
+    def replies(self, comment_id):
+        return self.children['t1_{}'.format(comment_id)]
+
 nominate_re = re.compile("""
 (nominate|vote|lynch)?         #vote or nominate is for clarity only, they have the same effect
 \s*:?\s*                       #could be a colon or not
@@ -146,11 +467,68 @@ class RedditHTMLParser(HTMLParser):
         if self.nest_count["strong"] > 0 and self.nest_count["del"] == 0:
             self.possible_votes.append(data)
 
-def get_possible_votes(post_contents):
+def get_possible_votes_htmlparser(post_contents):
     parser = RedditHTMLParser()
     parser.feed(parser.unescape(post_contents))
     return parser.possible_votes
 
+#Tokens HTMLParser finds in the html reddit makes for comments: tags,
+#character and entity references (which it drops, splitting the text around
+#them) and text. Anything else (a '<' which doesn't start a simple tag, which
+#can only come from the comment's text) is left to HTMLParser itself.
+#HTMLParser gives up on the rest of the comment at a broken character reference
+html_token_re = re.compile(r"""
+ <(?P<end>/)?(?P<tag>[a-zA-Z][a-zA-Z0-9]*)
+   (?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*
+   \s*(?P<empty>/)?>
+|&\#(?:[0-9]+|[xX][0-9a-fA-F]+)(?:;|(?=[^0-9a-fA-F]))
+|&[a-zA-Z][-.a-zA-Z0-9]*(?:;|(?=[^a-zA-Z0-9]))
+|(?P<bail>&\#)
+|(?P<text>[^<&]+|&)
+|(?P<other><)
+""", re.VERBOSE)
+
+html_entities = [('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'), ('&#39;', "'"), ('&amp;', '&')]
+
+def unescape_html(html, _unescape = HTMLParser().unescape):
+    """HTMLParser.unescape, using plain replaces when the html only has the
+    entities reddit uses when escaping comment html"""
+    if html.count('&') != sum(html.count(entity) for entity, char in html_entities):
+        return _unescape(html)
+    for entity, char in html_entities:
+        html = html.replace(entity, char)
+    return html
+
+def get_possible_votes(post_contents):
+    """Pieces of bold text which aren't struck through, the same as
+    RedditHTMLParser finds, but in a single pass over the html"""
+    possible_votes = []
+    strong = 0
+    struck = 0
+    html = unescape_html(post_contents)
+    for token in html_token_re.finditer(html):
+        text = token.group('text')
+        if text is not None:
+            if strong > 0 and struck == 0:
+                possible_votes.append(text)
+            continue
+        if token.group('other'):
+            return get_possible_votes_htmlparser(post_contents)
+        if token.group('bail'):
+            if ';' in html[token.start():] and strong > 0 and struck == 0:
+                possible_votes.append(token.group('bail'))
+            break
+        tag = token.group('tag')
+        if tag is None or token.group('empty'):
+            continue
+        tag = tag.lower()
+        change = -1 if token.group('end') else 1
+        if tag == 'strong':
+            strong += change
+        elif tag == 'del':
+            struck += change
+    return possible_votes
+
 def get_nomination_from_post(post_contents, valid_names):
     valid_votes = []
     for possible_vote in get_possible_votes(post_contents):
@@ -177,21 +555,416 @@ def get_vote_from_post(post_contents):
     if valid_votes:
         return valid_votes[-1]
 
-def compare_dicts(old, new):
-    old_items = set([(k,) + tuple(v.items()) for k,v in old.iteritems()])
-    new_items = set([(k,) + tuple(v.items()) for k,v in new.iteritems()])
+_missing = object()
+
+#Each name is kept as one string object however many votes and events use it
+interned_names = {}
+
+def intern_name(name):
+    if not isinstance(name, basestring):
+        return name
+    return interned_names.setdefault(name, name)
+
+class Record(object):
+    """A vote or history event. These are read like the dicts they are
+    stored as in the state file, but are a lot smaller in memory. keys are
+    the keys of the stored dict, in the order of the slots holding them.
+    Keys a record doesn't have are left out of the stored dict"""
+    __slots__ = ()
+    keys = ()
+    __hash__ = None
 
-    additions = new_items.difference(old_items)
-    removals = old_items.difference(new_items)
+    @classmethod
+    def from_json(cls, data):
+        record = cls.__new__(cls)
+        for slot, key in zip(cls.__slots__, cls.keys):
+            setattr(record, slot, intern_name(data.get(key, _missing)))
+        return record
 
-    additions = {i[0]: dict(i[1:]) for i in additions}
-    removals = {i[0]: dict(i[1:]) for i in removals}
+    def to_json(self):
+        return {key: value for key, value in self.items()}
 
+    def items(self):
+        return [(key, getattr(self, slot)) for slot, key in zip(self.__slots__, self.keys)
+                if getattr(self, slot) is not _missing]
+
+    def get(self, key, default = None):
+        try:
+            value = getattr(self, self.__slots__[self.keys.index(key)])
+        except ValueError:
+            return default
+        return default if value is _missing else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+        if isinstance(other, dict):
+            return self.to_json() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.to_json())
+
+class VoteRecord(Record):
+    __slots__ = ('target', 'lynch', 'timestamp')
+    keys = ('for', 'lynch', 'timestamp')
+
+class HistoryEvent(Record):
+    __slots__ = ('action', 'by', 'target', 'on', 'lynch', 'time')
+    keys = ('action', 'by', 'for', 'on', 'lynch', 'time')
+
+class VoteHistory(object):
+    """Index of a post's vote history by time, by voter and by the player
+    voted on (or nominated). The history list is only appended to, or has
+    its last events popped when a transaction is rolled back, so update()
+    only has to index the events added since it last ran. Events are
+    indexed by (time, position in the list), so events at the same time
+    keep the order they were added in. rebuilds counts the times the index
+    had to be started again"""
+    def __init__(self):
+        self.events = None
+        self.rebuilds = 0
+        self.clear()
+
+    def clear(self):
+        self.n_indexed = 0
+        self.last_event = None
+        self.by_time = []
+        self.voters = collections.defaultdict(list)
+        self.targets = collections.defaultdict(list)
+
+    @staticmethod
+    def target(event):
+        return event.get('on') if event['action'] == 'nominated' else event.get('for')
+
+    def update(self, events):
+        if (events is not self.events or len(events) < self.n_indexed or
+                (self.n_indexed and events[self.n_indexed - 1] is not self.last_event)):
+            self.events = events
+            self.rebuilds += 1
+            self.clear()
+        for seq in range(self.n_indexed, len(events)):
+            event = events[seq]
+            key = (event['time'], seq)
+            bisect.insort(self.by_time, key)
+            bisect.insort(self.voters[event['by']], key)
+            target = self.target(event)
+            if target is not None:
+                bisect.insort(self.targets[target], key)
+        self.n_indexed = len(events)
+        self.last_event = events[-1] if events else None
+
+    def lookup(self, keys):
+        return [self.events[seq] for event_time, seq in keys]
+
+    def in_order(self):
+        return self.lookup(self.by_time)
+
+    def by_voter(self, voter):
+        return self.lookup(self.voters.get(voter, []))
+
+    def on_target(self, target, start = None, end = None):
+        """Events on target from start to end inclusive"""
+        keys = self.targets.get(target, [])
+        first = 0 if start is None else bisect.bisect_left(keys, (start,))
+        last = len(keys) if end is None else bisect.bisect_right(keys, (end, float('Inf')))
+        return self.lookup(keys[first:last])
+
+    def last_before(self, deadline):
+        """The last event before deadline, or None"""
+        i = bisect.bisect_left(self.by_time, (deadline,))
+        return self.lookup(self.by_time[i - 1:i])[0] if i else None
+
+    def players(self):
+        return set(self.voters).union(self.targets)
+
+    def n_player_events(self, player):
+        """Number of index entries for player, which only changes when
+        events by or on them are added, or the index is rebuilt"""
+        return len(self.voters.get(player, [])) + len(self.targets.get(player, []))
+
+    def for_player(self, player):
+        """Events by or on player"""
+        return self.lookup(sorted(set(self.voters.get(player, [])).union(self.targets.get(player, []))))
+
+def record_to_json(obj):
+    """default for json.dump, to store records as dicts"""
+    if isinstance(obj, Record):
+        return obj.to_json()
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+def load_records(state):
+    """Turn the votes and vote history read into state as dicts into records"""
+    for posts_key in ('votes', 'nominations'):
+        posts = state.get(posts_key) or {}
+        for post_state in posts.values():
+            if post_state.get('vote_history'):
+                post_state['vote_history'] = [HistoryEvent.from_json(x) for x in post_state['vote_history']]
+            current_votes = post_state.get('current_votes') or {}
+            #nominations have a set of votes for each nominee
+            vote_sets = current_votes.values() if posts_key == 'nominations' else [current_votes]
+            for votes in vote_sets:
+                for voter in votes.keys():
+                    votes[intern_name(voter)] = VoteRecord.from_json(votes.pop(voter))
+
+def compare_dicts(old, new):
+    """Returns the keys whose value is new or changed in new, with their new
+    value, and the keys whose value is gone or changed, with their old value.
+    Values which are the same object in both aren't compared any further"""
+    additions = {}
+    removals = {}
+    for k, v in new.iteritems():
+        old_v = old.get(k, _missing)
+        if old_v is v:
+            continue
+        if old_v is _missing:
+            additions[k] = v
+        elif old_v != v:
+            additions[k] = v
+            removals[k] = old_v
+    if len(old) != len(new) - len(additions) + len(removals):
+        for k, v in old.iteritems():
+            if k not in new:
+                removals[k] = v
     return additions, removals
 
+#How long in seconds to trust a looked up name, and a name we couldn't find
+NAME_CASE_TTL = 30 * 24 * 60 * 60
+NAME_CASE_NEGATIVE_TTL = 24 * 60 * 60
+
+#Number of parsed comments to remember
+PARSE_CACHE_SIZE = 10000
+
+#Number of journal entries after which the state is written out in full
+JOURNAL_COMPACT_LENGTH = 1000
+
+#Number of comments to read from the subreddit's comment listing when streaming votes
+STREAM_PAGE_SIZE = 100
+
+#Number of messages to ask for at a time when reading new messages, and the
+#most to look through when the inbox cursor can't be used
+INBOX_PAGE_SIZE = 25
+INBOX_SCAN_LIMIT = 100
+
+#How far back in seconds from a hammer to list the votes on the lynched player
+#in the message sent to the moderators
+HAMMER_REVIEW_TIME = 10 * 60
+
+class StateTransaction(object):
+    """Changes to a bot's state which can be rolled back. Changes are written
+    straight into the live state and undone from a log if needed, so nothing
+    has to be copied up front. Paths are tuples of keys from the top of the
+    state"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.undo_log = []
+        self.changes = []
+
+    def record(self, action, path, value = None):
+        #serialised straight away, since the value may be changed later
+        self.changes.append(json.dumps({"generation": self.bot.state.get('journal_generation'),
+                                        "action": action,
+                                        "path": path,
+                                        "value": value}, default = record_to_json))
+
+    def lookup(self, path):
+        node = self.bot.state
+        for key in path:
+            node = node[key]
+        return node
+
+    def set(self, path, value):
+        container = self.lookup(path[:-1])
+        if container.get(path[-1], _missing) == value:
+            #nothing to undo or journal
+            return
+        self.undo_log.append(('set', path, container.get(path[-1], _missing)))
+        container[path[-1]] = value
+        self.record('set', path, value)
+
+    def delete(self, path):
+        container = self.lookup(path[:-1])
+        self.undo_log.append(('set', path, container.pop(path[-1], _missing)))
+        self.record('delete', path)
+
+    def append(self, path, value):
+        container = self.lookup(path[:-1])
+        if not container.get(path[-1]):
+            self.set(path, [])
+        container[path[-1]].append(value)
+        self.undo_log.append(('append', path, None))
+        self.record('append', path, value)
+
+    def reset(self):
+        self.undo_log.append(('reset', None, self.bot.state))
+        generation = self.bot.state.get('journal_generation')
+        self.bot.state = Tree()
+        if generation:
+            self.bot.state['journal_generation'] = generation
+        self.record('reset', None)
+
+    def apply(self, entry):
+        """Redo a change read back from the journal"""
+        if entry['action'] == 'set':
+            self.set(entry['path'], entry['value'])
+        elif entry['action'] == 'append':
+            self.append(entry['path'], entry['value'])
+        elif entry['action'] == 'delete':
+            self.delete(entry['path'])
+        elif entry['action'] == 'reset':
+            self.reset()
+
+    def commit(self):
+        if self.changes:
+            self.bot.state_version += 1
+        self.bot.journal.extend(self.changes)
+        self.undo_log = []
+        self.changes = []
+
+    def rollback(self):
+        for action, path, old in reversed(self.undo_log):
+            if action == 'reset':
+                self.bot.state = old
+            elif action == 'append':
+                self.lookup(path).pop()
+            elif old is _missing:
+                self.lookup(path[:-1]).pop(path[-1], None)
+            else:
+                self.lookup(path[:-1])[path[-1]] = old
+        self.undo_log = []
+        self.changes = []
+
+class VoteTally(object):
+    """The number of votes for each player in a traditional game's vote
+    state, counting every vote ('all') or only those of players who aren't
+    voteless ('real')"""
+    def __init__(self, tally_state):
+        self.tally_state = tally_state
+
+    def counts(self, real = False):
+        return self.tally_state.get('real' if real else 'all') or {}
+
+    def most_common(self, n = None, real = False):
+        return collections.Counter(self.counts(real)).most_common(n)
+
+    def leader(self, real = False):
+        """(player, votes) for the player with the most votes, or None"""
+        most_common = self.most_common(1, real)
+        return most_common[0] if most_common else None
+
+@contextlib.contextmanager
+def atomic_file(filename):
+    """Open a temporary file to write in place of filename, which is renamed
+    over it once it has been written, so readers never see a partial file"""
+    fd, temp_filename = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(filename)),
+                                         prefix = '.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as temp_fd:
+            yield temp_fd
+            temp_fd.flush()
+            os.fsync(temp_fd.fileno())
+        os.chmod(temp_filename, 0o644)
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
+
+def fingerprint(data):
+    return hashlib.sha1(json.dumps(data, sort_keys = True, default = record_to_json)).hexdigest()
+
 def get_edited_time(comment):
     return comment.edited if comment.edited else comment.created_utc
 
+class InboxReader(object):
+    """Reads the messages which arrived since the last read, once for all
+    games, and hands commands to the games they are for. The cursor is the
+    newest message read, and is saved to filename once every game has dealt
+    with the commands sent to it"""
+    def __init__(self, reddit, filename):
+        self.reddit = reddit
+        self.filename = filename
+        self.cursor = None
+        self.saved_cursor = None
+
+    def load(self):
+        try:
+            with open(self.filename) as cursor_fd:
+                self.cursor = json.load(cursor_fd)
+        except IOError:
+            l.warning("No inbox cursor, reading the last {} messages".format(INBOX_SCAN_LIMIT))
+        except ValueError:
+            l.error("Could not read inbox cursor, reading the last {} messages".format(INBOX_SCAN_LIMIT))
+        self.saved_cursor = self.cursor
+
+    def save(self, bots):
+        if self.cursor == self.saved_cursor or any(bot.command_queue for bot in bots):
+            return
+        with atomic_file(self.filename) as cursor_fd:
+            json.dump(self.cursor, cursor_fd)
+        self.saved_cursor = self.cursor
+
+    def new_messages(self):
+        """Messages since the cursor, newest first"""
+        newest = list(self.reddit.get_inbox(limit = 1))
+        if not newest or (self.cursor and newest[0].fullname == self.cursor['fullname']):
+            return []
+        if not self.cursor:
+            return list(self.reddit.get_inbox(limit = INBOX_SCAN_LIMIT))
+        messages = []
+        before = self.cursor['fullname']
+        while True:
+            page = self.inbox_page(before)
+            messages[:0] = page
+            if len(page) < INBOX_PAGE_SIZE:
+                break
+            before = page[0].fullname
+        if not messages:
+            #reddit gives nothing before a message which has been deleted
+            l.warning("Inbox cursor {} is gone, scanning recent messages".format(self.cursor['fullname']))
+            messages = [pm for pm in self.reddit.get_inbox(limit = INBOX_SCAN_LIMIT)
+                        if pm.created_utc >= self.cursor['created_utc']]
+        return messages
+
+    def inbox_page(self, before):
+        """The page of messages just after before. With a limit, praw goes on
+        to ask for the next page of a short page, with before still set, so
+        it is given a limit of 0 to make exactly one request"""
+        return list(self.reddit.get_inbox(limit = 0, params = {'before': before,
+                                                               'limit': INBOX_PAGE_SIZE}))
+
+    def dispatch(self, bots):
+        """Add new commands to the front of the command queue of the bots they
+        are for, and have those bots update straight away"""
+        messages = self.new_messages()
+        if not messages:
+            return
+        self.cursor = {'fullname': messages[0].fullname, 'created_utc': messages[0].created_utc}
+        queues = {bot.args.name.lower(): [] for bot in bots}
+        for pm in messages:
+            if pm.subject.count(':') != 1:
+                continue
+            game_name = pm.subject.split(':')[0].lower().strip()
+            for name, queue in queues.items():
+                if game_name == name or game_name == "*":
+                    queue.append(pm)
+        for bot in bots:
+            bot.command_queue[:0] = queues[bot.args.name.lower()]
+            if bot.command_queue:
+                bot.next_update_at = 0
+
 def timestamp_to_date(timestamp):
     return datetime.datetime.fromtimestamp(timestamp, pytz.utc).isoformat()
 
@@ -205,6 +978,51 @@ class VoteBot(object):
         self.reddit = reddit
         self.args = args
         self.max_trials = 5
+        self.journal = []
+        self.journal_length = None
+        self.rendered = {}
+        self.parse_cache = LRUCache(PARSE_CACHE_SIZE)
+        self.state_version = 0
+        self.sorted_nominations = {}
+        self.missing_names = set()
+        self.history_written = {}
+        self.history_indexes = collections.defaultdict(VoteHistory)
+        self.activity = False
+        self.near_hammer = False
+        self.update_delay = None
+        self.next_update_at = 0
+        self.command_queue = []
+        self.stream_target = None
+        self.stream_cursor = None
+        self.stream_seen = set()
+        comment_db = None
+        if args.state_file:
+            comment_db = os.path.splitext(args.state_file)[0] + '_comments.db'
+        self.comment_cache = CommentCache(comment_db)
+
+    def is_counting(self):
+        return self.state['counting_votes'] or self.state['counting_nominations']
+
+    def is_streaming(self):
+        """Whether stream_votes should be called between updates"""
+        return False
+
+    def schedule_update(self, base_delay, min_delay, max_delay):
+        """Work out when to next update this game: soon if votes changed in
+        the last update or a hammer is close, backing off while nothing
+        happens and waiting the longest while we aren't counting anything"""
+        if not self.is_counting():
+            delay = max_delay
+        elif self.activity or self.near_hammer:
+            delay = min_delay
+        elif self.update_delay is None:
+            delay = base_delay
+        else:
+            delay = self.update_delay * 2
+        self.update_delay = max(min_delay, min(max_delay, delay))
+        self.next_update_at = time.time() + self.update_delay
+        self.activity = False
+        l.debug("Next update of {} in {} seconds".format(self.args.name, self.update_delay))
 
     def setup_dir(self):
         if not os.path.exists(self.args.output_dir):
@@ -212,16 +1030,16 @@ class VoteBot(object):
 
     def process_commands(self):
         l.debug("Processing commands for {}".format(self.args.name))
-        new_state = copy.deepcopy(self.state)
-        pms = self.reddit.get_inbox(limit = None)
+        pms = list(self.command_queue)
         have_nominations = False
         have_votes = False
         most_recent_id = None
-        alive_players = set(new_state["alive_players"])
-        dead_players = set(new_state["dead_players"])
-        voteless_players = set(new_state["voteless_players"])
+        alive_players = set(self.state["alive_players"])
+        dead_players = set(self.state["dead_players"])
+        voteless_players = set(self.state["voteless_players"])
         voteless_players.difference_update(dead_players)
         alive_players.difference_update(dead_players)
+        old_alive_players = set(alive_players)
         pms_reversed = []
         for pm in pms:
             if ":" not in pm.subject:
@@ -241,118 +1059,196 @@ class VoteBot(object):
             if command == "reset":
                 break
 
-        pms_reversed.reverse()
-        for pm in pms_reversed:
-            game_name, command = pm.subject.split(':')
-            game_name = game_name.lower().strip()
-            command = command.lower().strip()
-            l.debug('command: {}'.format(command))
-            if command == "end nominations" and not have_nominations:
-                l.info("Command: end nominations")
-                new_state['nominations_ended_at'] = pm.created_utc
-                have_nominations = True
-            if command == "end votes" and not have_votes:
-                l.info("Command: end votes")
-                new_state['votes_ended_at'] = pm.created_utc
-                have_votes = True
-            if command == "nominations" and not have_nominations:
-                l.info("Command: new nominations thread")
-                new_state['nominations_url'] = pm.body
-                new_state['nominations_ended_at'] = None
-                new_state['counting_nominations'] = True
-                have_nominations = True
-            if command == "votes" and not have_votes:
-                l.info("Command: new votes thread")
-                new_state['votes_url'] = pm.body.split()[0]
-                new_state['nominated_players'] = pm.body.split()[1:]
-                new_state['votes_ended_at'] = None
-                new_state['vote_threshold'] = None
-                new_state['counting_votes'] = True
-                have_votes = True
-            if command in ('alive', 'dead', 'gone', 'voteless', 'voteful'):
-                player_set = set([x.lower() for x in pm.body.split() if len(x) > 3])
-                if command == "alive":
-                    l.info("Command: alive players")
-                    alive_players.update(player_set)
-                elif command == "dead":
-                    l.info("Command: dead players")
-                    alive_players.difference_update(player_set)
-                    dead_players.update(player_set)
-                elif command == "gone":
-                    l.info("Command: gone players")
-                    alive_players.difference_update(player_set)
-                    dead_players.difference_update(player_set)
-                    voteless_players.difference_update(player_set)
-                elif command == "voteless":
-                    l.info("Voteless players")
-                    voteless_players.update(player_set)
-                elif command == "voteful":
-                    l.info("Voteful players")
-                    voteless_players.difference_update(player_set)
-                else:
-                    l.warning("Unknown command {}".format(command))
-            if command == "max nominations":
-                try:
-                    self.max_trials = int(pm.body.strip())
-                except ValueError:
-                    l.warning("Got invalid value for max nominations: {}".format(pm.body.strip()))
-            if command == "reset":
-                l.warning("Got reset command")
-                new_state = Tree()
-                alive_players = set()
-                dead_players = set()
-                voteless_players = set()
-            if command == "vote threshold":
-                l.info("Command: new vote threshold")
-                try:
-                    threshold = int(pm.body)
-                except ValueError:
-                    l.warn("Invalid number given for vote threshold: {}".format(pm.body))
-                new_state['vote_threshold'] = threshold
-
-        new_state['alive_players'] = list(alive_players)
-        new_state['dead_players'] = list(dead_players)
-        new_state['voteless_players'] = list(voteless_players)
-        if most_recent_id:
-            new_state['most_recent_pm_id'] = most_recent_id
+        with self.transaction() as txn:
+            pms_reversed.reverse()
+            for pm in pms_reversed:
+                game_name, command = pm.subject.split(':')
+                game_name = game_name.lower().strip()
+                command = command.lower().strip()
+                l.debug('command: {}'.format(command))
+                if command == "end nominations" and not have_nominations:
+                    l.info("Command: end nominations")
+                    txn.set(('nominations_ended_at',), pm.created_utc)
+                    have_nominations = True
+                if command == "end votes" and not have_votes:
+                    l.info("Command: end votes")
+                    txn.set(('votes_ended_at',), pm.created_utc)
+                    have_votes = True
+                if command == "nominations" and not have_nominations:
+                    l.info("Command: new nominations thread")
+                    txn.set(('nominations_url',), pm.body)
+                    txn.set(('nominations_ended_at',), None)
+                    txn.set(('counting_nominations',), True)
+                    have_nominations = True
+                if command == "votes" and not have_votes:
+                    l.info("Command: new votes thread")
+                    txn.set(('votes_url',), pm.body.split()[0])
+                    txn.set(('nominated_players',), pm.body.split()[1:])
+                    txn.set(('votes_ended_at',), None)
+                    txn.set(('vote_threshold',), None)
+                    txn.set(('counting_votes',), True)
+                    have_votes = True
+                if command in ('alive', 'dead', 'gone', 'voteless', 'voteful'):
+                    player_set = set([x.lower() for x in pm.body.split() if len(x) > 3])
+                    if command == "alive":
+                        l.info("Command: alive players")
+                        alive_players.update(player_set)
+                    elif command == "dead":
+                        l.info("Command: dead players")
+                        alive_players.difference_update(player_set)
+                        dead_players.update(player_set)
+                    elif command == "gone":
+                        l.info("Command: gone players")
+                        alive_players.difference_update(player_set)
+                        dead_players.difference_update(player_set)
+                        voteless_players.difference_update(player_set)
+                    elif command == "voteless":
+                        l.info("Voteless players")
+                        voteless_players.update(player_set)
+                    elif command == "voteful":
+                        l.info("Voteful players")
+                        voteless_players.difference_update(player_set)
+                    else:
+                        l.warning("Unknown command {}".format(command))
+                if command == "rebuild logs":
+                    l.info("Command: rebuild logs")
+                    self.rendered.clear()
+                    self.history_written.clear()
+                if command == "max nominations":
+                    try:
+                        self.max_trials = int(pm.body.strip())
+                    except ValueError:
+                        l.warning("Got invalid value for max nominations: {}".format(pm.body.strip()))
+                if command == "reset":
+                    l.warning("Got reset command")
+                    txn.reset()
+                    alive_players = set()
+                    dead_players = set()
+                    voteless_players = set()
+                if command == "vote threshold":
+                    l.info("Command: new vote threshold")
+                    try:
+                        txn.set(('vote_threshold',), int(pm.body))
+                    except ValueError:
+                        l.warn("Invalid number given for vote threshold: {}".format(pm.body))
+
+            if alive_players != old_alive_players:
+                #votes are parsed against who is alive, so old results are useless
+                self.parse_cache.clear()
+            #the lists are only written when they hold different players,
+            #not just the same ones in a different order
+            for key, players in (('alive_players', alive_players),
+                                 ('dead_players', dead_players),
+                                 ('voteless_players', voteless_players)):
+                if self.state.get(key) is None or set(self.state[key]) != players:
+                    txn.set((key,), list(players))
+            if most_recent_id:
+                txn.set(('most_recent_pm_id',), most_recent_id)
+        #only forget the commands once they've been applied
+        del self.command_queue[len(self.command_queue) - len(pms):]
         l.debug("Done processing commands, updating state")
-        self.state = new_state
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Make changes to the state which are all undone if anything fails,
+        and which are added to the journal if they succeed"""
+        txn = StateTransaction(self)
+        try:
+            yield txn
+        except:
+            txn.rollback()
+            raise
+        txn.commit()
+
+    def set_state(self, path, value):
+        with self.transaction() as txn:
+            txn.set(path, value)
+
+    def history_event(self, action, voter, vote, timestamp):
+        return HistoryEvent.from_json({"action" : action,
+                                       "lynch" : vote['lynch'],
+                                       "by" : voter,
+                                       "for" : vote['for'],
+                                       "time" : timestamp})
+
+    def record_vote_changes(self, txn, post_path, old_votes, votes):
+        """Add the differences between old_votes and votes to the vote history.
+        Returns the differences, as from compare_dicts"""
+        additions, removals = compare_dicts(old_votes, votes)
+        if additions or removals:
+            self.activity = True
+        for voter, vote in sorted(additions.items()):
+            txn.append(post_path + ('vote_history',),
+                       self.history_event("vote", voter, vote, vote['timestamp']))
+        for voter, vote in sorted(removals.items()):
+            timestamp = votes[voter]['timestamp'] if voter in votes else int(time.time())
+            txn.append(post_path + ('vote_history',),
+                       self.history_event("unvote", voter, vote, timestamp))
+        return additions, removals
+
+    def vote_threshold(self):
+        vote_threshold = self.state['vote_threshold']
+        if not isinstance(vote_threshold, int):
+            vote_threshold = (len(self.state['alive_players']) - len(self.state['voteless_players']))/ 2 + 1
+        return vote_threshold
+
+    def vote_tally(self, post_id):
+        return VoteTally(self.state['votes'][post_id].get('tally') or {})
 
     def get_bot_post(self, submission_url, tag = None):
+        submission, bot_posts = self.get_bot_posts(submission_url, [tag])
+        return submission, bot_posts[tag]
+
+    def get_bot_posts(self, submission_url, tags):
+        """Fetch the submission once and find the bot comment for each tag
+        (None matches any bot comment). Returns the submission and a dict of
+        tag -> comment, with None for tags that weren't found"""
         l.debug("Fetching submission from {}".format(submission_url))
         submission = praw.objects.Submission.from_url(self.reddit, submission_url)
         l.debug("Got submission")
-        comment_to_update = None
-        for comment in all_comments(submission.comments):
+        bot_posts = dict.fromkeys(tags)
+        remaining = set(tags)
+        for comment in all_comments(submission.comments, self.comment_cache):
+            if not remaining:
+                break
             if comment.author and comment.author.name == self.bot_username:
-                if tag is None:
-                    comment_to_update = comment
-                    break
-                else:
-                    if comment.body.lower().find('###{}###'.format(tag.lower())) != -1:
-                        comment_to_update = comment
+                body = comment.body.lower()
+                for tag in list(remaining):
+                    if tag is None or body.find('###{}###'.format(tag.lower())) != -1:
+                        l.debug("Got comment for {}".format(tag))
+                        bot_posts[tag] = comment
+                        remaining.remove(tag)
                         break
 
-        if comment_to_update:
-            l.debug("Got comment")
-        return submission, comment_to_update
+        return submission, bot_posts
+
+    def parse_comment(self, comment, parse, parse_key):
+        """parse(comment.body_html), remembered until the comment is edited.
+        parse_key must identify parse and anything else its result depends on"""
+        key = (comment.id, get_edited_time(comment), parse_key)
+        result = self.parse_cache.get(key, _missing)
+        if result is _missing:
+            result = parse(comment.body_html)
+            self.parse_cache.put(key, result)
+        return result
 
-    def get_votes(self, vote_post, target_player, old_votes, deadline, get_vote = get_vote_from_post):
+    def get_votes(self, vote_comments, target_player, old_votes, deadline,
+                  get_vote = get_vote_from_post, vote_key = 'yay/nay'):
         valid_names = {x.lower() for x in self.state['alive_players']}
         #can_vote = valid_names.difference({x.lower() for x in state['voteless_players']})
         can_vote = valid_names
         votes = {}
-        for vote_comment in all_comments(vote_post.replies):
+        for vote_comment in vote_comments:
             if not vote_comment.author:
                 continue
-            vote_result = get_vote(vote_comment.body_html)
+            vote_result = self.parse_comment(vote_comment, get_vote, vote_key)
             if vote_result is None:
                 if vote_comment.id not in self.known_invalid_votes:
                     l.warn("Did not get vote result from {}".format(vote_comment.body_html.encode('ascii', errors='ignore')))
                     self.known_invalid_votes.add(vote_comment.id)
                 continue
 
-            caster = vote_comment.author.name.lower()
+            caster = intern_name(vote_comment.author.name.lower())
             if caster not in can_vote:
                 if vote_comment.id not in self.known_invalid_votes:
                     #voteless is kinda-secret
@@ -376,33 +1272,52 @@ class VoteBot(object):
 
             #if multiple votes are present, count the latest one
             if (caster not in votes) or votes[caster]['timestamp'] > timestamp:
-                votes[caster] = {"for" : target_player,
-                                 #Confusing terminology: in nomination games,
-                                 #'lynch' is a bool. In tradition games, it is a
-                                 #string with the same meaning as 'for in nomination
-                                 #games. 'for' is None in traditional games
-                                 "lynch" : vote_result,
-                                 "timestamp": timestamp}
+                vote = VoteRecord.from_json({"for" : target_player,
+                        #Confusing terminology: in nomination games,
+                        #'lynch' is a bool. In tradition games, it is a
+                        #string with the same meaning as 'for in nomination
+                        #games. 'for' is None in traditional games
+                        "lynch" : vote_result,
+                        "timestamp": timestamp})
+                #keep unchanged votes as the same object, so compare_dicts can skip them
+                if caster in old_votes and old_votes[caster] == vote:
+                    vote = old_votes[caster]
+                votes[caster] = vote
 
         return votes
 
-    def sort_nominations(self, post_state):
-        def votes(nominee):
-            vote_info = post_state['current_votes'][nominee].values()
-            votes = [v['lynch'] for v in vote_info if v['timestamp'] < deadline]
-            yays = sum(votes)
-            nays = len(votes) - yays
-            return yays, nays
+    def tally_nominations(self, post_state):
+        """Yays and nays cast before the deadline for each nominee"""
         deadline = post_state['deadline'] if post_state['deadline'] else float('Inf')
+        tallies = {}
+        for nominee in post_state['current_nominations']:
+            yays = nays = 0
+            for vote in post_state['current_votes'][nominee].itervalues():
+                if vote['timestamp'] < deadline:
+                    if vote['lynch']:
+                        yays += 1
+                    else:
+                        nays += 1
+            tallies[nominee] = (yays, nays)
+        return tallies
+
+    def sort_nominations(self, post_state):
+        #the templates ask for this several times per render, so it is only
+        #worked out again once the state has changed
+        memo_key = (id(post_state), self.state_version, self.max_trials)
+        if memo_key in self.sorted_nominations:
+            return self.sorted_nominations[memo_key]
+        tallies = self.tally_nominations(post_state)
+        dead_players = set(self.state['dead_players'])
         sorted_nominations = post_state['current_nominations'].items()
-        sorted_nominations.sort(key = lambda x: (x[0] not in self.state['dead_players'],
-                                                 votes(x[0])[1] - votes(x[0])[0],
+        sorted_nominations.sort(key = lambda x: (x[0] not in dead_players,
+                                                 tallies[x[0]][1] - tallies[x[0]][0],
                                                  x[1]['timestamp']))
         n_trials = 0
         nominations = []
         for nominee, nomination in sorted_nominations:
-            yays, nays = votes(nominee)
-            up_for_trial = nominee not in self.state['dead_players'] and n_trials < self.max_trials and yays > nays
+            yays, nays = tallies[nominee]
+            up_for_trial = nominee not in dead_players and n_trials < self.max_trials and yays > nays
             if up_for_trial:
                 n_trials += 1
             nominations.append(Nomination(player = nominee,
@@ -414,44 +1329,118 @@ class VoteBot(object):
 
         nominations.sort(key = lambda x: (not bool(x.yays + x.nays), x.timestamp))
 
+        self.sorted_nominations = {memo_key: nominations}
         return nominations
 
     def fix_case(self, username):
+        """Properly capitalised name for username. Never goes to reddit, names
+        which haven't been looked up yet are returned as they are and looked
+        up by the next prefetch_names"""
         if username in self.state['name_case_cache']:
             return self.state['name_case_cache'][username]
+        self.missing_names.add(username)
+        return username
 
+    def lookup_name_case(self, username):
+        """The proper name of username, None if reddit doesn't know it, or
+        _missing if we couldn't find out"""
         l.debug("Finding proper name for {}".format(username))
         try:
             user = praw.objects.Redditor(self.reddit, username)
         except requests.HTTPError:
             l.warn("Username {} doesn't appear to exist!".format(username))
-            self.state['name_case_cache'][username] = username
-            return username
+            return None
         #there should be a better way...
         try:
             comment = user.get_comments().next()
-        except:
+        except (StopIteration, praw.errors.NotFound):
             comment = None
+        except Exception:
+            l.warn("Couldn't look up the name of {}:\n{}".format(username, traceback.format_exc()))
+            return _missing
         if not comment:
             l.warn("No comments by {}? can't work out their proper name!".format(username))
-            self.state['name_case_cache'][username] = username
-            return username
+            return None
         l.debug("{} -> {}".format(username, comment.author.name))
-        self.state['name_case_cache'][username] = comment.author.name
         return comment.author.name
 
+    def name_case_key(self):
+        """Changes whenever a name in the name case cache is added or changes
+        case, so logs written with the old names can be written again"""
+        return fingerprint(self.state['name_case_cache'])
+
+    def name_case_expired(self, username):
+        if username not in self.state['name_case_checked']:
+            #names cached before we kept track of when are kept
+            return username not in self.state['name_case_cache']
+        checked_at, found = self.state['name_case_checked'][username]
+        ttl = NAME_CASE_TTL if found else NAME_CASE_NEGATIVE_TTL
+        return time.time() - checked_at > ttl
+
+    def prefetch_names(self):
+        """Look up the proper names of all the players (and any names
+        fix_case couldn't find) before rendering. Names which couldn't be
+        looked up are tried again next time"""
+        usernames = set(self.state['alive_players'])
+        usernames.update(self.state['dead_players'])
+        usernames.update(self.state['voteless_players'])
+        usernames.update(self.missing_names)
+        usernames = sorted(x for x in usernames if self.name_case_expired(x))
+        self.missing_names = set()
+        if not usernames:
+            return
+        l.info("Looking up proper names for {} users".format(len(usernames)))
+        #one at a time, since the session can't be used from several threads
+        names = [self.lookup_name_case(username) for username in usernames]
+        with self.transaction() as txn:
+            for username, name in zip(usernames, names):
+                if name is _missing:
+                    continue
+                txn.set(('name_case_cache', username), name if name else username)
+                txn.set(('name_case_checked', username), [time.time(), bool(name)])
+
+    def template_inputs(self, template, post, target):
+        """The parts of the state which template reads when rendered for
+        post/target, so we can tell when rendering it again would give the
+        same result"""
+        state = self.state
+        inputs = [template, target, state['name_case_cache'],
+                  [self.args.name_pretty, self.args.output_url,
+                   self.args.hammers, self.args.secret_voteless]]
+        if template == 'players.template':
+            inputs += [state['alive_players'], state['dead_players'], state['voteless_players']]
+        elif template == 'nomination_post.template':
+            inputs += [state['nominations'][target] if target else None, state['dead_players'],
+                       state['nominations_url'], state['nominations_ended_at'], self.max_trials]
+        elif post is None or template in ('vote_history.template', 'vote_history_traditional.template'):
+            #templates for posts that don't exist yet are always rendered, and
+            #history logs are kept up to date by update_history_log
+            return None
+        elif template == 'nomination_state.template':
+            inputs += [post.id, state['nominations'][post.id]['current_nominations'],
+                       state['nominations'][post.id]['current_votes']]
+        else:
+            inputs += [post.id, state['votes'][post.id]['current_votes'], state['votes_ended_at'],
+                       state['vote_threshold'], state['alive_players'], state['voteless_players']]
+        return fingerprint(inputs)
+
     def update_post(self, submission, post, post_template, target = None):
         l.debug("Updating post from template {}".format(post_template))
-        if submission:
-            with open(post_template) as post_template_fd:
-                template = simpletemplate.SimpleTemplate(post_template_fd.read())
-                post_contents = template.render(state = self.state, target = target,
-                                                sort_nominations = self.sort_nominations,
-                                                time = timestamp_to_date,
-                                                post = post,
-                                                output_url = self.args.output_url,
-                                                fix_case = self.fix_case,
-                                                args = self.args)
+        render_key = (post_template, post.id if post else None, target)
+        inputs = self.template_inputs(post_template, post, target)
+        if submission and inputs is not None and inputs == self.rendered.get(render_key):
+            l.debug("Post inputs are unchanged, not rendering")
+        elif submission:
+            template = simpletemplate.load_template(post_template)
+            post_contents = template.render(state = self.state, target = target,
+                                            sort_nominations = self.sort_nominations,
+                                            vote_tally = self.vote_tally,
+                                            vote_threshold = self.vote_threshold,
+                                            time = timestamp_to_date,
+                                            post = post,
+                                            output_url = self.args.output_url,
+                                            fix_case = self.fix_case,
+                                            args = self.args)
 
             if not post:
                 l.info("Making new post")
@@ -464,6 +1453,8 @@ class VoteBot(object):
                     if not args.dry_run:
                         post.edit(post_contents)
                     l.info(post_contents)
+                #rendering may have filled in the name case cache, so look again
+                self.rendered[render_key] = self.template_inputs(post_template, post, target)
 
         l.debug("Done updating post")
 
@@ -471,44 +1462,154 @@ class VoteBot(object):
         l.debug("Updating logfile {}".format(filename))
         if args.dry_run:
             return
-        with open(template) as template_fd:
-            template = simpletemplate.SimpleTemplate(template_fd.read())
-            contents = template.render(state = self.state, post = post,
-                                       time = timestamp_to_date,
-                                       fix_case = self.fix_case,
-                                       args = self.args)
-        with open(os.path.join(self.args.output_dir, filename), 'w') as log_fd:
-            log_fd.write(contents)
+        log_filename = os.path.join(self.args.output_dir, filename)
+        inputs = self.template_inputs(template, post, None)
+        if inputs is not None and inputs == self.rendered.get(log_filename) and os.path.exists(log_filename):
+            l.debug("Logfile inputs are unchanged, not rendering")
+            return
+        template_name = template
+        template = simpletemplate.load_template(template)
+        with atomic_file(log_filename) as log_fd:
+            template.stream(log_fd, state = self.state, post = post,
+                            time = timestamp_to_date,
+                            fix_case = self.fix_case,
+                            args = self.args)
+        self.rendered[log_filename] = self.template_inputs(template_name, post, None)
+
+    def update_history_log(self, filename, post, template):
+        """Like update_log, but only appends the events added to the vote
+        history since the last write, unless they would sort before events
+        already written or names in the log may have changed case. Then the
+        whole log is written again from the events in time order"""
+        l.debug("Updating history logfile {}".format(filename))
+        if args.dry_run:
+            return
+        log_filename = os.path.join(self.args.output_dir, filename)
+        history = self.vote_history(post.id)
+        vote_history = history.events
+        names = self.name_case_key()
+        n_written, last_time, written_names = self.history_written.get(log_filename, (None, None, None))
+        rebuild = (n_written is None or n_written > len(vote_history) or
+                   written_names != names or not os.path.exists(log_filename))
+        new_events = vote_history if rebuild else vote_history[n_written:]
+        if rebuild or any(event['time'] <= last_time for event in new_events):
+            new_events = history.in_order()
+            with atomic_file(log_filename) as log_fd:
+                simpletemplate.load_template(template).stream(log_fd, state = self.state, post = post,
+                                                              events = new_events,
+                                                              time = timestamp_to_date,
+                                                              fix_case = self.fix_case,
+                                                              args = self.args)
+            last_time = None
+        elif new_events:
+            l.debug("Appending {} events to {}".format(len(new_events), filename))
+            with open(log_filename, 'a') as log_fd:
+                simpletemplate.load_template(template).stream(log_fd, state = self.state, post = post,
+                                                              events = new_events,
+                                                              time = timestamp_to_date,
+                                                              fix_case = self.fix_case,
+                                                              args = self.args)
+        for event in new_events:
+            last_time = max(last_time, event['time'])
+        self.history_written[log_filename] = (len(vote_history), last_time, names)
+        self.update_player_history_logs(post, template)
+
+    def update_player_history_logs(self, post, template):
+        """Write a history log for each player in the vote history of post,
+        of the votes they made and the votes on them. Only the players with
+        events added since their log was written have their events looked up"""
+        history = self.vote_history(post.id)
+        names = self.name_case_key()
+        indexed = (history.rebuilds, history.n_indexed, names)
+        if self.history_written.get(('players', post.id)) == indexed:
+            return
+        for player in history.players():
+            filename = '{}_history_{}.txt'.format(post.id, re.sub(r'[^\w-]', '_', player))
+            log_filename = os.path.join(self.args.output_dir, filename)
+            written = (history.rebuilds, history.n_player_events(player), names)
+            if written == self.history_written.get(log_filename) and os.path.exists(log_filename):
+                continue
+            l.debug("Updating history logfile {}".format(filename))
+            with atomic_file(log_filename) as log_fd:
+                simpletemplate.load_template(template).stream(log_fd, state = self.state, post = post,
+                                                              events = history.for_player(player),
+                                                              time = timestamp_to_date,
+                                                              fix_case = self.fix_case,
+                                                              args = self.args)
+            self.history_written[log_filename] = written
+        self.history_written[('players', post.id)] = indexed
+
+    def vote_history(self, post_id):
+        """The VoteHistory index of the vote history of post_id, up to date
+        with the state"""
+        posts = self.state['nominations'] if post_id in self.state['nominations'] else self.state['votes']
+        history = self.history_indexes[post_id]
+        history.update(posts[post_id].get('vote_history') or [])
+        return history
 
     def load_state(self, state_filename):
+        """Load the last snapshot of the state and replay the journal of
+        changes made since it was written"""
         try:
             with open(state_filename) as state_fd:
                 self.state = json.load(state_fd, object_hook = Tree)
         except IOError:
             pass
 
+        generation = self.state.get('journal_generation')
+        try:
+            with open(state_filename + '.journal') as journal_fd:
+                for line in journal_fd:
+                    try:
+                        entry = json.loads(line, object_hook = Tree)
+                    except ValueError:
+                        l.warning("Ignoring incomplete journal entry in {}".format(state_filename))
+                        break
+                    if entry.get('generation') == generation:
+                        StateTransaction(self).apply(entry)
+        except IOError:
+            pass
+
+        load_records(self.state)
+
         if self.state['game_type'] and self.state['game_type'] != self.args.game_type:
-            raise RuntimeError("Wrong game type for state! state is {}, we're running {}".format(state['game_type'], self.args.game_type))
+            raise RuntimeError("Wrong game type for state! state is {}, we're running {}".format(self.state['game_type'], self.args.game_type))
 
         self.state['game_type'] = self.args.game_type
-
+        self.journal = []
+        self.journal_length = None
 
     def save_state(self, state_filename):
+        """Append the changes since the last save to the journal, or write a
+        new snapshot once the journal has grown long enough"""
         if not state_filename:
             return
-        with open(state_filename, 'w') as state_fd:
-            json.dump(self.state, state_fd, indent=2)
+        if self.journal_length is None or self.journal_length + len(self.journal) > JOURNAL_COMPACT_LENGTH:
+            l.debug("Writing state snapshot to {}".format(state_filename))
+            self.state['journal_generation'] = self.state.get('journal_generation', 0) + 1
+            with atomic_file(state_filename) as state_fd:
+                json.dump(self.state, state_fd, indent=2, default = record_to_json)
+            open(state_filename + '.journal', 'w').close()
+            self.journal_length = 0
+        elif self.journal:
+            with open(state_filename + '.journal', 'a') as journal_fd:
+                for entry in self.journal:
+                    journal_fd.write(entry + '\n')
+                journal_fd.flush()
+                os.fsync(journal_fd.fileno())
+            self.journal_length += len(self.journal)
+        self.journal = []
+        self.comment_cache.commit()
 
 class NominationBot(VoteBot):
-    def acknowledge_nomination(self, comment, target):
-        for potential_bot_comment in all_comments(comment.replies):
-            if potential_bot_comment.author.name == self.bot_username:
+    def acknowledge_nomination(self, comment, target, replies):
+        for potential_bot_comment in replies:
+            if potential_bot_comment.author and potential_bot_comment.author.name == self.bot_username:
                 #TODO: more checking here
                 l.debug("Found old acknowledge post for {}".format(target))
                 return potential_bot_comment
-        with open('nomination_ack.template') as post_template_fd:
-            template = simpletemplate.SimpleTemplate(post_template_fd.read())
-            post_contents = template.render(state = self.state, target = target, fix_case = self.fix_case)
+        template = simpletemplate.load_template('nomination_ack.template')
+        post_contents = template.render(state = self.state, target = target, fix_case = self.fix_case)
         l.info("Acknowledging nomination for {}".format(target))
         if args.dry_run:
             return None
@@ -517,94 +1618,74 @@ class NominationBot(VoteBot):
 
     def get_nominations(self, nomination_post):
         l.debug("Counting nominations")
-        new_state = copy.deepcopy(self.state)
         valid_names = {x.lower() for x in self.state['alive_players']}
         #TODO: voteless does not affect nominations currently.
-        nomination_state = new_state['nominations'][nomination_post.id]
-        nomination_state['deadline'] = new_state['nominations_ended_at']
+        post_path = ('nominations', nomination_post.id)
+        nomination_state = self.state['nominations'][nomination_post.id]
         nominations = nomination_state['current_nominations']
-        for nomination_comment in all_comments(nomination_post.replies):
-            nominee = get_nomination_from_post(nomination_comment.body_html, valid_names)
-            if not nominee:
-                continue
-            if not nomination_comment.author:
-                continue
-            caster = nomination_comment.author.name.lower()
-            if caster not in valid_names:
-                if nomination_comment not in known_invalid_votes:
-                    l.info("{} cannot nominate ({} can)!".format(caster, valid_names))
-                    known_invalid_votes.add(nomination_comment.id)
-                continue
-
-            if nominee in nominations:
-                continue
-
-            #Try to find the time the nomination was made
-            timestamp = get_edited_time(nomination_comment)
-
-            if self.state['nominations_ended_at'] and timestamp > self.state['nominations_ended_at']:
-                continue
-
-            ack = self.acknowledge_nomination(nomination_comment, nominee)
-            vote_history = nomination_state.get('vote_history', [])
-            if not vote_history:
-                vote_history = []
-            vote_history.append({"action": "nominated",
-                                 "by": caster,
-                                 "on": nominee,
-                                 "time": timestamp})
-            nomination_state['vote_history'] = vote_history
-
-            nominations[nominee] = {"by" : caster,
-                                    "timestamp": timestamp,
-                                    "ack_id": ack.id,
-                                    "for" : nominee}
-
-        by_acks_id = {}
-
-        for nominee, nomination in nominations.items():
-            by_acks_id[nomination['ack_id']] = nomination
-
-        for nomination_comment in all_comments(nomination_post.replies):
-            for ack_comment in all_comments(nomination_comment.replies):
-                if ack_comment.id in by_acks_id:
-                    nomination = by_acks_id[ack_comment.id]
-                    nominee = nomination['for']
-                    old_votes = copy.deepcopy(nomination_state['current_votes'][nominee])
-                    votes = self.get_votes(ack_comment, nominee, old_votes, self.state['nominations_ended_at'])
-                    nomination_state['current_votes'][nominee] = votes
-                    additions, removals = compare_dicts(old_votes, votes)
-                    vote_history = nomination_state.get('vote_history', [])
-                    if not vote_history:
-                        vote_history = []
-                    for voter, vote in additions.items():
-                        vote_history.append({"action" : "vote",
-                                             "lynch" : vote['lynch'],
-                                             "by" : voter,
-                                             "for" : vote['for'],
-                                             "time" : vote['timestamp']})
-                    for voter, vote in removals.items():
-                        timestamp = votes[voter]['timestamp'] if voter in votes else int(time.time())
-                        vote_history.append({"action" : "unvote",
-                                             "lynch" : vote['lynch'],
-                                             "by" : voter,
-                                             "for" : vote['for'],
-                                             "time" : timestamp})
-                    nomination_state['vote_history'] = vote_history
-                    break
-
-        if new_state['nominations_ended_at']:
-            new_state['counting_nominations'] = False
-        self.state = new_state
+        comment_index = CommentIndex(nomination_post, self.comment_cache)
+        get_nomination = lambda post_contents: get_nomination_from_post(post_contents, valid_names)
+        nomination_key = ('nominate', frozenset(valid_names))
+        with self.transaction() as txn:
+            txn.set(post_path + ('deadline',), self.state['nominations_ended_at'])
+            for nomination_comment in comment_index.replies(nomination_post.id):
+                nominee = self.parse_comment(nomination_comment, get_nomination, nomination_key)
+                if not nominee:
+                    continue
+                if not nomination_comment.author:
+                    continue
+                caster = nomination_comment.author.name.lower()
+                if caster not in valid_names:
+                    if nomination_comment.id not in self.known_invalid_votes:
+                        l.info("{} cannot nominate ({} can)!".format(caster, valid_names))
+                        self.known_invalid_votes.add(nomination_comment.id)
+                    continue
+
+                if nominee in nominations:
+                    continue
+
+                #Try to find the time the nomination was made
+                timestamp = get_edited_time(nomination_comment)
+
+                if self.state['nominations_ended_at'] and timestamp > self.state['nominations_ended_at']:
+                    continue
+
+                ack = self.acknowledge_nomination(nomination_comment, nominee,
+                                                  comment_index.replies(nomination_comment.id))
+                txn.append(post_path + ('vote_history',),
+                           HistoryEvent.from_json({"action": "nominated",
+                                                   "by": caster,
+                                                   "on": nominee,
+                                                   "time": timestamp}))
+
+                self.activity = True
+                txn.set(post_path + ('current_nominations', nominee),
+                        {"by" : caster,
+                         "timestamp": timestamp,
+                         "ack_id": ack.id,
+                         "for" : nominee})
+
+            for nominee, nomination in nominations.items():
+                if not comment_index.has_comment(nomination['ack_id']):
+                    continue
+                old_votes = nomination_state['current_votes'][nominee]
+                votes = self.get_votes(comment_index.replies(nomination['ack_id']),
+                                       nominee, old_votes, self.state['nominations_ended_at'])
+                txn.set(post_path + ('current_votes', nominee), votes)
+                self.record_vote_changes(txn, post_path, old_votes, votes)
+
+            if self.state['nominations_ended_at']:
+                txn.set(('counting_nominations',), False)
         l.debug("Done counting nominations")
 
     def update_state(self):
         self.process_commands()
+        self.prefetch_names()
         if self.state['nominations_url'] and self.state['counting_nominations']:
             nomination_submission, nomination_post = self.get_bot_post(self.state['nominations_url'], 'nominate')
             if nomination_post:
                 self.get_nominations(nomination_post)
-                self.update_log('{}_history.txt'.format(nomination_post.id),
+                self.update_history_log('{}_history.txt'.format(nomination_post.id),
                                 nomination_post, 'vote_history.template')
                 self.update_log('{}_votes.txt'.format(nomination_post.id),
                                 nomination_post, 'nomination_state.template')
@@ -612,94 +1693,126 @@ class NominationBot(VoteBot):
                              target=nomination_post.id if nomination_post else None)
 
         if self.state['votes_url'] and self.state['counting_votes']:
+            votes_submission, votes_posts = self.get_bot_posts(self.state['votes_url'],
+                    ['vote ' + nominee for nominee in self.state['nominated_players']])
             for nominee in self.state['nominated_players']:
-                votes_submission, votes_post = self.get_bot_post(self.state['votes_url'], 'vote ' + nominee)
+                votes_post = votes_posts['vote ' + nominee]
                 if votes_post:
                     self.count_votes(votes_post, nominee)
-                    self.update_log('{}_history.txt'.format(votes_post.id),
+                    self.update_history_log('{}_history.txt'.format(votes_post.id),
                                     votes_post, 'vote_history.template')
                     self.update_log('{}_votes.txt'.format(votes_post.id),
                                     votes_post, 'vote_state.template')
                 self.update_post(votes_submission, votes_post, 'vote_post.template', nominee)
             if self.state['votes_ended_at']:
-                self.state['counting_votes'] = False
+                self.set_state(('counting_votes',), False)
 
     def count_votes(self, vote_post, nominee):
         l.debug("Counting votes")
-        new_state = copy.deepcopy(self.state)
+        post_path = ('votes', vote_post.id)
         old_votes = self.state['votes'][vote_post.id]['current_votes']
-        votes_state = new_state['votes'][vote_post.id]
-        votes = self.get_votes(vote_post, nominee, old_votes, self.state['votes_ended_at'])
-
-        additions, removals = compare_dicts(old_votes, votes)
-        vote_history = votes_state.get('vote_history', [])
-        if not vote_history:
-            vote_history = []
-        for voter, vote in additions.items():
-            vote_history.append({"action" : "vote",
-                                 "lynch" : vote['lynch'],
-                                 "by" : voter,
-                                 "for" : vote['for'],
-                                 "time" : vote['timestamp']})
-        for voter, vote in removals.items():
-            timestamp = votes[voter]['timestamp'] if voter in votes else int(time.time())
-            vote_history.append({"action" : "unvote",
-                                 "lynch" : vote['lynch'],
-                                 "by" : voter,
-                                 "for" : vote['for'],
-                                 "time" : timestamp})
-
-        votes_state['vote_history'] = vote_history
-        votes_state['current_votes'] = votes
+        votes = self.get_votes(all_comments(vote_post.replies, self.comment_cache),
+                               nominee, old_votes, self.state['votes_ended_at'])
 
-        self.state = new_state
+        with self.transaction() as txn:
+            self.record_vote_changes(txn, post_path, old_votes, votes)
+            txn.set(post_path + ('current_votes',), votes)
         l.debug("Done counting votes")
 
 
 class TraditionalBot(VoteBot):
+    def is_counting(self):
+        return self.state['votes_url'] and not self.state['votes_ended_at']
+
+    def is_streaming(self):
+        return self.stream_target is not None and self.is_counting()
+
     def update_state(self):
         self.process_commands()
-        self.state['name_case_cache']['no lynch'] = 'No Lynch'
+        if self.state['name_case_cache']['no lynch'] != 'No Lynch':
+            self.set_state(('name_case_cache', 'no lynch'), 'No Lynch')
+        self.prefetch_names()
         if self.state['votes_url']:
             vote_submission, vote_post = self.get_bot_post(self.state['votes_url'], 'vote')
             if vote_post:
+                self.stream_target = (str(vote_submission.subreddit), vote_post.id)
                 self.count_votes(vote_post)
-                self.update_log('{}_history.txt'.format(vote_post.id),
+                if self.check_hammer(vote_post.id):
+                    #the voting ended at the hammer, so count again without
+                    #the votes after it, as the thread won't be counted again
+                    self.count_votes(vote_post)
+                self.update_history_log('{}_history.txt'.format(vote_post.id),
                                 vote_post, 'vote_history_traditional.template')
                 self.update_log('{}_votes.txt'.format(vote_post.id),
                                 vote_post, 'vote_state_traditional.template')
-
-                votes = self.state['votes'][vote_post.id]['current_votes']
-                vote_counts = collections.Counter([v['lynch'] for v in votes.values()])
-                real_vote_counts = collections.Counter([v['lynch'] for caster, v in votes.items()
-                                   if caster not in self.state['voteless_players']])
-                if not self.args.secret_voteless:
-                    vote_counts = real_vote_counts
-                vote_threshold = self.state['vote_threshold']
-                if not isinstance(vote_threshold, int):
-                    vote_threshold = (len(self.state['alive_players']) - len(self.state['voteless_players']))/ 2 + 1
-                if len(vote_counts) and real_vote_counts.most_common(1)[0][1] >= vote_threshold and not self.state['votes_ended_at'] and args.hammers:
-                    self.state['votes_ended_at'] = time.time()
-                    v_url = state['votes_url']
-                    self.state['votes_url'] = ""
-                    lynched_player = real_vote_counts.most_common(1)[0][0]
-                    for user in self.authorized_users:
-                        if not args.dry_run:
-                            self.reddit.send_message(user, "Hammer",
-                            "The voting at {} has reached "
-                            "a majority for {} . You might want to check the voting "
-                            "history and edit times if there were a few last-minute vote changes".format(v_url, lynched_player))
             self.update_post(vote_submission, vote_post, 'vote_post_traditional.template', None)
+        if self.state.get('hammered_url') is not None:
+            #a hammer from stream_votes has now been shown, so stop counting,
+            #unless a new votes thread has been started since
+            with self.transaction() as txn:
+                if self.state['hammered_url'] == self.state['votes_url']:
+                    txn.set(('votes_url',), "")
+                txn.delete(('hammered_url',))
         self.update_log('players.txt', None, 'players.template')
 
 
-    def count_votes(self, vote_post):
-        l.debug("Counting votes")
-        new_state = copy.deepcopy(self.state)
-
-        old_votes = self.state['votes'][vote_post.id]['current_votes']
-        votes_state = new_state['votes'][vote_post.id]
-
+    def check_hammer(self, post_id, stop_counting = True):
+        """End the voting if someone has a majority, as of the vote which gave
+        it to them. The votes thread is also forgotten, or if stop_counting is
+        False, marked to be forgotten once the next update has shown the
+        hammer. Returns whether the voting was ended"""
+        vote_threshold = self.vote_threshold()
+        leader = self.vote_tally(post_id).leader(real = True)
+        self.near_hammer = bool(leader) and leader[1] >= vote_threshold - 1
+        if not leader or self.state['votes_ended_at'] or not self.args.hammers:
+            return False
+        lynched_player, n_votes = leader
+        if n_votes < vote_threshold:
+            return False
+        voteless_players = set(self.state['voteless_players'])
+        hammer_time = sorted(v['timestamp'] for caster, v
+                             in self.state['votes'][post_id]['current_votes'].items()
+                             if v['lynch'] == lynched_player and caster not in voteless_players
+                             )[max(vote_threshold, 1) - 1]
+        v_url = self.state['votes_url']
+        with self.transaction() as txn:
+            txn.set(('votes_ended_at',), hammer_time)
+            if stop_counting:
+                txn.set(('votes_url',), "")
+            else:
+                txn.set(('hammered_url',), v_url)
+        l.info("Hammer on {} at {}".format(lynched_player, timestamp_to_date(hammer_time)))
+        review = self.hammer_review(post_id, lynched_player, hammer_time)
+        for user in self.authorized_users:
+            if not args.dry_run:
+                self.reddit.send_message(user, "Hammer",
+                "The voting at {} has reached "
+                "a majority for {} . You might want to check the voting "
+                "history and edit times if there were a few last-minute vote changes"
+                "\n\n{}".format(v_url, lynched_player, review))
+        return True
+
+    def hammer_review(self, post_id, lynched_player, hammer_time):
+        """The votes on lynched_player in the HAMMER_REVIEW_TIME up to the
+        hammer, and the last vote change before it, for the moderators"""
+        history = self.vote_history(post_id)
+
+        def describe(event):
+            action = {'vote': 'voted for', 'unvote': 'removed their vote for'}[event['action']]
+            return "{} {} {} at {}".format(self.fix_case(event['by']), action,
+                                           self.fix_case(event['for']), timestamp_to_date(event['time']))
+
+        lines = ["Votes on {} in the {} minutes up to the hammer:".format(
+                 self.fix_case(lynched_player), HAMMER_REVIEW_TIME // 60), ""]
+        lines += ["* " + describe(event) for event
+                  in history.on_target(lynched_player, hammer_time - HAMMER_REVIEW_TIME, hammer_time)]
+        last_event = history.last_before(hammer_time)
+        if last_event:
+            lines += ["", "The last vote change before the hammer: " + describe(last_event)]
+        return "\n".join(lines)
+
+    def vote_parser(self):
+        """The function to get a vote from a comment, and its key in the parse cache"""
         valid_names = {x.lower() for x in self.state['alive_players']}
         valid_names.add('no lynch')
 
@@ -707,31 +1820,104 @@ class TraditionalBot(VoteBot):
             res = get_nomination_from_post(post_contents, valid_names)
             return res
 
-        votes = self.get_votes(vote_post, None, old_votes, self.state['votes_ended_at'], get_vote = get_vote)
+        return get_vote, ('vote', frozenset(valid_names))
+
+    def stream_votes(self):
+        l.debug("Streaming votes")
+        subreddit, vote_post_id = self.stream_target
+        #the listing would otherwise come from praw's cache between polls. When
+        #logged in with OAuth it is cached under the oauth url
+        self.reddit.evict([self.reddit.config['subreddit_comments'].format(subreddit = subreddit),
+                           '{}/r/{}/comments'.format(self.reddit.config.oauth_url, subreddit)])
+        comments = list(self.reddit.get_comments(subreddit, limit = STREAM_PAGE_SIZE))
+        if self.stream_cursor is None:
+            new_comments = []
+        else:
+            new_comments = [c for c in reversed(comments) if c.id not in self.stream_seen
+                            and c.created_utc >= self.stream_cursor]
+            if len(new_comments) == STREAM_PAGE_SIZE:
+                l.debug("Missed some comments, the next update will find them")
+        if comments:
+            self.stream_cursor = max(c.created_utc for c in comments)
+            self.stream_seen = {c.id for c in comments}
+
+        vote_comments = [c for c in new_comments if c.parent_id == 't1_{}'.format(vote_post_id)]
+        if not vote_comments:
+            return
+        post_path = ('votes', vote_post_id)
+        get_vote, vote_key = self.vote_parser()
+        #one at a time, so nothing after the hammer is counted
+        for vote_comment in vote_comments:
+            old_votes = self.state['votes'][vote_post_id]['current_votes']
+            new_votes = self.get_votes([vote_comment], None, old_votes, self.state['votes_ended_at'],
+                                       get_vote = get_vote, vote_key = vote_key)
+            #a new comment only counts where get_votes would have picked it
+            votes = dict(old_votes)
+            for caster, vote in new_votes.items():
+                if caster not in votes or votes[caster]['timestamp'] > vote['timestamp']:
+                    votes[caster] = vote
+            if votes == old_votes:
+                continue
+            with self.transaction() as txn:
+                self.set_votes(txn, post_path, old_votes, votes)
+            #keep the votes thread so the next update shows the hammer
+            if self.check_hammer(vote_post_id, stop_counting = False):
+                self.next_update_at = 0
+                break
 
-        additions, removals = compare_dicts(old_votes, votes)
-        vote_history = votes_state.get('vote_history', [])
-        if not vote_history:
-            vote_history = []
-        for voter, vote in additions.items():
-            vote_history.append({"action" : "vote",
-                                 "for" : vote['lynch'],
-                                 "by" : voter,
-                                 "time" : vote['timestamp']})
-
-        for voter, vote in removals.items():
-            timestamp = votes[voter]['timestamp'] if voter in votes else int(time.time())
-            vote_history.append({"action" : "unvote",
-                                 "for" : vote['lynch'],
-                                 "by" : voter,
-                                 "time" : timestamp})
+    def count_votes(self, vote_post):
+        l.debug("Counting votes")
+        post_path = ('votes', vote_post.id)
+        old_votes = self.state['votes'][vote_post.id]['current_votes']
 
-        votes_state['vote_history'] = vote_history
-        votes_state['current_votes'] = votes
+        get_vote, vote_key = self.vote_parser()
+        votes = self.get_votes(all_comments(vote_post.replies, self.comment_cache),
+                               None, old_votes, self.state['votes_ended_at'], get_vote = get_vote,
+                               vote_key = vote_key)
 
-        self.state = new_state
+        with self.transaction() as txn:
+            self.set_votes(txn, post_path, old_votes, votes)
         l.debug("Done counting votes")
 
+    def set_votes(self, txn, post_path, old_votes, votes):
+        """Replace the current votes, adding the changes to the vote history
+        and the tally. The tally is counted again if the voteless players
+        have changed since it was last counted"""
+        additions, removals = self.record_vote_changes(txn, post_path, old_votes, votes)
+        tally_path = post_path + ('tally',)
+        voteless_players = sorted(self.state['voteless_players'])
+        tally = txn.lookup(post_path).get('tally')
+        if not tally or tally.get('voteless') != voteless_players:
+            all_counts = collections.Counter([v['lynch'] for v in votes.values()])
+            real_counts = collections.Counter([v['lynch'] for caster, v in votes.items()
+                                               if caster not in voteless_players])
+            txn.set(tally_path, {'all': dict(all_counts),
+                                 'real': dict(real_counts),
+                                 'voteless': voteless_players})
+        else:
+            for voter, vote in removals.items():
+                self.count_vote(txn, tally_path, voter, vote, -1)
+            for voter, vote in additions.items():
+                self.count_vote(txn, tally_path, voter, vote, 1)
+        txn.set(post_path + ('current_votes',), votes)
+
+    def count_vote(self, txn, tally_path, voter, vote, change):
+        kinds = ('all',) if voter in txn.lookup(tally_path)['voteless'] else ('all', 'real')
+        for kind in kinds:
+            counts = txn.lookup(tally_path + (kind,))
+            n_votes = counts.get(vote['lynch'], 0) + change
+            if n_votes:
+                txn.set(tally_path + (kind, vote['lynch']), n_votes)
+            else:
+                txn.delete(tally_path + (kind, vote['lynch']))
+
+    def history_event(self, action, voter, vote, timestamp):
+        #traditional votes keep who they are for in 'lynch'
+        return HistoryEvent.from_json({"action" : action,
+                                       "for" : vote['lynch'],
+                                       "by" : voter,
+                                       "time" : timestamp})
+
 def oauth_login(r):
     r.set_oauth_app_info(client_id = creds.oauth_id,
                          client_secret = creds.oauth_secret,
@@ -762,12 +1948,30 @@ def oauth_refresh(r, access_info):
         json.dump(json_safe_access_info, access_fd, indent=2)
     return access_info
 
+def oauth_share(r, access_info):
+    """Log another session in with the access information of the main one"""
+    r.set_oauth_app_info(client_id = creds.oauth_id,
+                         client_secret = creds.oauth_secret,
+                         redirect_uri="http://127.0.0.1:65010/authorize_callback")
+    r.set_access_credentials(**access_info)
+
 if __name__ == "__main__":
     args = parser.parse_args()
 
     l.setLevel(debug_levels[args.log_level])
     l.info("Starting up")
-    r = praw.Reddit(user_agent = "VoteCountBot by rcxdude")
+    request_bucket = gateway.TokenBucket(args.requests_per_minute / 60.0, args.request_burst)
+    request_stats = gateway.RequestStats()
+
+    def new_session():
+        #praw sessions can't be used from several threads at once, so each
+        #game gets its own, all sharing the rate limit and stats
+        return praw.Reddit(user_agent = "VoteCountBot by rcxdude",
+                           handler = gateway.GatewayHandler(request_bucket, request_stats))
+
+    r = new_session()
+    worker_sessions = [new_session() for i in range(args.comment_workers)] if args.comment_workers > 1 else []
+    set_comment_workers(worker_sessions)
 
     bots = []
     last_refresh_time = None
@@ -783,11 +1987,14 @@ if __name__ == "__main__":
             "traditional" : TraditionalBot,
         }[game.game_type]
 
-        bot = BotClass(r, creds, game)
+        bot = BotClass(new_session(), creds, game)
         bot.load_state(bot.args.state_file)
         bot.setup_dir()
         bots.append(bot)
 
+    inbox = InboxReader(r, args.inbox_cursor_file)
+    inbox.load()
+
     while True:
         l.info("Attempting login")
         try:
@@ -801,23 +2008,65 @@ if __name__ == "__main__":
             l.error(traceback.format_exc())
             time.sleep(60 * args.update_delay)
 
+    sessions = [bot.reddit for bot in bots] + worker_sessions
     oauth_access_info = oauth_refresh(r, oauth_access_info)
+    for session in sessions:
+        oauth_share(session, oauth_access_info)
     last_refresh_time = time.time()
 
     l.info("Logged in")
 
+    def update_bot(bot):
+        gateway.set_game(bot.args.name)
+        start_time = time.time()
+        try:
+            bot.update_state()
+            bot.comment_cache.prune()
+            bot.save_state(bot.args.state_file)
+        except Exception as e:
+            l.error("Error updating {}:\n{}".format(bot.args.name, traceback.format_exc()))
+        l.debug("Updated {} in {:.1f} seconds".format(bot.args.name, time.time() - start_time))
+        bot.schedule_update(60 * args.update_delay, 60 * args.min_update_delay,
+                            60 * args.max_update_delay)
+
+    pool = multiprocessing.pool.ThreadPool(max(1, min(args.parallel_games, len(bots))))
+
     while True:
-        for bot in bots:
-            try:
-                bot.update_state()
-                bot.save_state(bot.args.state_file)
-            except Exception as e:
-                l.error(traceback.format_exc())
-        if args.oneshot:
-            break
+        #before the updates, so the token can't run out during them
         if time.time() - last_refresh_time > 40 * 60:
             l.info("Refreshing OAuth information")
             oauth_access_info = oauth_refresh(r, oauth_access_info)
+            for session in sessions:
+                oauth_share(session, oauth_access_info)
             last_refresh_time = time.time()
-        l.debug("done, sleeping for {} seconds".format(60 * args.update_delay))
-        time.sleep(60 * args.update_delay)
+        try:
+            inbox.dispatch(bots)
+        except Exception as e:
+            l.error("Error reading inbox:\n{}".format(traceback.format_exc()))
+        pool.map(update_bot, [bot for bot in bots if bot.next_update_at <= time.time()])
+        request_report = request_stats.report()
+        if request_report:
+            l.info("Requests since last update:\n{}".format(request_report))
+        inbox.save(bots)
+        if args.oneshot:
+            break
+        #games which aren't counting may not be due for a while, but the inbox
+        #is still read every update_delay for new commands
+        next_inbox_at = time.time() + 60 * args.update_delay
+        next_update_at = min([bot.next_update_at for bot in bots] + [next_inbox_at])
+        l.debug("done, sleeping for {:.0f} seconds".format(max(0, next_update_at - time.time())))
+        while time.time() < next_update_at:
+            if args.stream_interval <= 0:
+                time.sleep(next_update_at - time.time())
+                break
+            time.sleep(max(0, min(args.stream_interval, next_update_at - time.time())))
+            for bot in bots:
+                if not bot.is_streaming():
+                    continue
+                gateway.set_game(bot.args.name)
+                try:
+                    bot.stream_votes()
+                    bot.save_state(bot.args.state_file)
+                except Exception as e:
+                    l.error("Error streaming votes for {}:\n{}".format(bot.args.name, traceback.format_exc()))
+            next_update_at = min([bot.next_update_at for bot in bots] + [next_inbox_at])